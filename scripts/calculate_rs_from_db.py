@@ -4,11 +4,11 @@ import sys
 import json
 import argparse
 import logging
+from functools import lru_cache
 from datetime import datetime, timedelta
 import pandas as pd
 import numpy as np
 import arcticdb as adb
-from tqdm.auto import tqdm
 
 try:
     from pandas_market_calendars import get_calendar
@@ -16,34 +16,87 @@ except ImportError:
     get_calendar = None
     logging.warning("pandas_market_calendars not installed. Falling back to consecutive days for RSRATING.csv.")
 
-def quarters_perf(closes: pd.Series, n: int) -> float:
-    days = n * 63
-    available_data = closes[-min(len(closes), days):]
-    if len(available_data) < 1:
-        return np.nan
-    elif len(available_data) == 1:
-        return 0.0  # For IPOs, use 0% change as baseline
-    pct_change = available_data.pct_change().dropna()
-    return (pct_change + 1).cumprod().iloc[-1] - 1 if not pct_change.empty else np.nan
-
-def strength(closes: pd.Series) -> float:
-    perfs = [quarters_perf(closes, i) for i in range(1, 5)]
-    valid_perfs = [p for p in perfs if not np.isnan(p)]
-    if not valid_perfs:
-        return np.nan
-    weights = [0.4, 0.2, 0.2, 0.2][:len(valid_perfs)]
-    total_weight = sum(weights)
-    weights = [w / total_weight for w in weights] if total_weight > 0 else weights
-    return sum(w * p for w, p in zip(weights, valid_perfs))
-
-def relative_strength(closes: pd.Series, closes_ref: pd.Series) -> float:
-    rs_stock = strength(closes)
-    rs_ref = strength(closes_ref)
-    if np.isnan(rs_stock) or np.isnan(rs_ref):
-        logging.info(f"NaN RS for ticker with {len(closes)} days, ref with {len(closes_ref)} days")
-        return np.nan
-    rs = (1 + rs_stock) / (1 + rs_ref) * 100
-    return round(rs, 2) if rs <= 590 else np.nan
+# Longest window any RS column looks at: four quarters behind the 6M offset
+MAX_LOOKBACK_DAYS = 4 * 63 + 120
+
+def strength_matrix(closes_mat: np.ndarray, valid_lens: np.ndarray) -> np.ndarray:
+    """Weighted four-quarter strength for every row of a left-aligned, NaN-padded closes matrix."""
+    rows = np.arange(closes_mat.shape[0])
+    last = closes_mat[rows, np.maximum(valid_lens - 1, 0)]
+    perfs = np.empty((len(rows), 4))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # Compounded daily returns telescope to last / base - 1; a zero base gives inf
+        for i, days in enumerate((63, 126, 189, 252)):
+            base = closes_mat[rows, np.maximum(valid_lens - days, 0)]
+            perfs[:, i] = last.astype(np.float64) / base - 1
+    perfs[valid_lens < 1] = np.nan
+    weights = np.where(np.isnan(perfs), 0.0, [0.4, 0.2, 0.2, 0.2])
+    total_weight = weights.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(total_weight > 0, np.nansum(weights * perfs, axis=1) / total_weight, np.nan)
+
+def build_closes_matrix(closes_list):
+    valid_lens = np.array([len(c) for c in closes_list], dtype=np.int64)
+    closes_mat = np.full((len(closes_list), max(valid_lens.max(initial=0), 1)), np.nan, dtype=np.float32)
+    if valid_lens.any():
+        # Row-major fill of the mask lays each ticker's closes into the head of its row in one copy
+        closes_mat[np.arange(closes_mat.shape[1]) < valid_lens[:, None]] = np.concatenate(closes_list)
+    return closes_mat, valid_lens
+
+def strength_by_offset(closes_mat: np.ndarray, valid_lens: np.ndarray, offsets) -> np.ndarray:
+    """Strength of every ticker with the last `offset` days dropped, one column per offset."""
+    return np.column_stack([strength_matrix(closes_mat, np.maximum(valid_lens - offset, 0)) for offset in offsets])
+
+def relative_strength(rs_stock: np.ndarray, rs_ref: float) -> np.ndarray:
+    if np.isnan(rs_ref):
+        return np.full(len(rs_stock), np.nan)
+    with np.errstate(invalid="ignore"):
+        rs = (1 + rs_stock) / (1 + rs_ref) * 100
+        return np.where(rs <= 590, np.round(rs, 2), np.nan)
+
+def calculate_rs_percentile(values: np.ndarray) -> np.ndarray:
+    percentiles = np.full(values.shape, np.nan)
+    valid = ~np.isnan(values)
+    if valid.any():
+        valid_values = values[valid]
+        # Same as rank(method="min") - 1: ties share the lowest position
+        ranks = np.searchsorted(np.sort(valid_values), valid_values, side="left")
+        # Same buckets as pd.qcut(ranks, 100, labels=False, duplicates="drop") without building a Categorical
+        edges = np.unique(np.percentile(ranks, np.linspace(0, 1, 101) * 100))
+        buckets = np.searchsorted(edges, ranks, side="left")
+        buckets[ranks == edges[0]] = 1
+        # A single distinct edge leaves no interval to fall into, which qcut reports as NaN
+        percentiles[valid] = np.where(buckets < len(edges), buckets - 1, np.nan)
+    return percentiles
+
+METADATA_COLUMNS = {
+    "info.Price": "Price",
+    "info.DVol": "DVol",
+    "info.sector": "Sector",
+    "info.industry": "Industry",
+    "info.AvgVol": "AvgVol",
+    "info.AvgVol10": "AvgVol10",
+    "info.52WKH": "52WKH",
+    "info.52WKL": "52WKL",
+    "info.MCAP": "MCAP",
+    "info.type": "Type",
+}
+
+def load_metadata(metadata_file):
+    with open(metadata_file, "r") as f:
+        data = json.load(f)
+    logging.info(f"Metadata file structure: {type(data).__name__}")
+    if isinstance(data, dict):
+        # Old logic: data is a dict with tickers as keys
+        metadata_df = pd.json_normalize(list(data.values())).assign(Ticker=list(data.keys()))
+    elif isinstance(data, list):
+        # Newer format: list of ticker objects
+        metadata_df = pd.json_normalize(data).rename(columns={"ticker": "Ticker"})
+    else:
+        raise ValueError(f"Unsupported metadata format: {type(data).__name__}")
+    metadata_df = metadata_df.rename(columns=METADATA_COLUMNS).reindex(columns=["Ticker", *METADATA_COLUMNS.values()])
+    metadata_df["Price"] = pd.to_numeric(metadata_df["Price"], errors="coerce").round(2)
+    return metadata_df
 
 def load_arctic_db(data_dir):
     try:
@@ -61,18 +114,39 @@ def load_arctic_db(data_dir):
         print(f"❌ ArcticDB error in {data_dir}: {str(e)}")
         return None
 
+def read_closes(lib, tickers):
+    """Read the last MAX_LOOKBACK_DAYS closes for all tickers in a single batched ArcticDB call."""
+    results = lib.read_batch([
+        adb.ReadRequest(t, columns=["close"], row_range=(-MAX_LOOKBACK_DAYS, None)) for t in tickers
+    ])
+    closes_by_ticker = {}
+    failed_tickers = []
+    for ticker, item in zip(tickers, results):
+        if isinstance(item, adb.DataError):
+            failed_tickers.append((ticker, str(item)))
+            continue
+        closes_by_ticker[ticker] = np.ascontiguousarray(item.data["close"].to_numpy(), dtype=np.float32)
+    return closes_by_ticker, failed_tickers
+
+@lru_cache(maxsize=1)
+def _nyse_calendar():
+    return get_calendar('NYSE')
+
+@lru_cache(maxsize=8)
+def _trading_schedule(start_date, end_date):
+    # Holiday rules are built once per process; callers must not mutate the cached frame
+    return _nyse_calendar().schedule(start_date=start_date, end_date=end_date)
+
 def generate_tradingview_csv(df_stocks, output_dir, ref_data, percentile_values=None, use_trading_days=True):
     if percentile_values is None:
         percentile_values = [98, 89, 69, 49, 29, 9, 1]
-    
-    lines = []
+
     latest_date = datetime.fromtimestamp(ref_data["datetime"].max())
     logging.info(f"Using latest date {latest_date} for RSRATING.csv")
 
     if use_trading_days and get_calendar is not None:
         try:
-            calendar = get_calendar('NYSE')
-            trading_days = calendar.schedule(start_date=latest_date - timedelta(days=7), end_date=latest_date)
+            trading_days = _trading_schedule(latest_date - timedelta(days=7), latest_date)
             if len(trading_days) < 5:
                 raise ValueError(f"Insufficient trading days found: {len(trading_days)}")
             dates = trading_days.index[-5:].strftime('%Y%m%dT')
@@ -96,16 +170,14 @@ def generate_tradingview_csv(df_stocks, output_dir, ref_data, percentile_values=
             first_rs_values[percentile] = 0
             logging.warning(f"No stocks found for percentile {percentile}, defaulting to 0")
 
-    for percentile in sorted(percentile_values, reverse=True):
-        rs_value = first_rs_values[percentile]
-        for date_str in dates:
-            csv_row = f"{date_str},0,1000,0,{rs_value},0\n"
-            lines.append(csv_row)
-
-    csv_content = ''.join(lines)
+    csv_content = "".join(
+        f"{date_str},0,1000,0,{first_rs_values[percentile]},0\n"
+        for percentile in sorted(percentile_values, reverse=True)
+        for date_str in dates
+    )
     with open(os.path.join(output_dir, "RSRATING.csv"), "w") as csv_file:
         csv_file.write(csv_content)
-    logging.info(f"Generated RSRATING.csv with {len(lines)} rows")
+    logging.info(f"Generated RSRATING.csv with {len(percentile_values) * len(dates)} rows")
     return csv_content
 
 def main(arctic_db_path, reference_ticker, output_dir, log_file, metadata_file=None, percentiles=None):
@@ -127,72 +199,37 @@ def main(arctic_db_path, reference_ticker, output_dir, log_file, metadata_file=N
         sys.exit(1)
 
     # Validate reference ticker data
-    ref_data = lib.read(reference_ticker).data
-    ref_closes = pd.Series(ref_data["close"].values, index=pd.to_datetime(ref_data["datetime"], unit='s'))
+    # Only the reference needs timestamps (for the RSRATING.csv dates); tickers are read as closes only
+    ref_data = lib.read(reference_ticker, columns=["close", "datetime"]).data
+    ref_closes = np.ascontiguousarray(ref_data["close"].to_numpy(), dtype=np.float32)
     if len(ref_closes) < 20:
         logging.error(f"Reference ticker {reference_ticker} has insufficient data ({len(ref_closes)} days)")
         print(f"❌ Not enough reference ticker data.")
         sys.exit(1)
 
+    # Reference strength per lookback offset is the same for every ticker, so compute it once
+    # with the same matrix code the tickers go through
+    rs_offsets = [("RS", 0), ("1M_RS", 20), ("3M_RS", 60), ("6M_RS", 120)]
+    offsets = [offset for _, offset in rs_offsets]
+    ref_strengths = dict(zip(offsets, strength_by_offset(*build_closes_matrix([ref_closes]), offsets)[0]))
+    for offset, rs_ref in ref_strengths.items():
+        if np.isnan(rs_ref):
+            logging.info(f"NaN RS for ref with {len(ref_closes) - offset} days")
+
+    rs_tickers = [t for t in tickers if t != reference_ticker]
+    # read_batch already runs the reads concurrently in ArcticDB's own thread pool
+    closes_by_ticker, failed_tickers = read_closes(lib, rs_tickers)
+    for ticker, error in failed_tickers:
+        logging.info(f"{ticker}: Failed to process ({error})")
+
     # Pre-check insufficient data tickers
-    insufficient_tickers = []
-    for ticker in tickers:
-        if ticker == reference_ticker:
-            continue
-        try:
-            data = lib.read(ticker).data
-            closes = pd.Series(data["close"].values, index=pd.to_datetime(data["datetime"], unit='s'))
-            if len(closes) < 1:
-                insufficient_tickers.append(ticker)
-        except Exception:
-            insufficient_tickers.append(ticker)
+    insufficient_tickers = [t for t in rs_tickers if len(closes_by_ticker.get(t, ())) < 1]
     logging.info(f"Found {len(insufficient_tickers)} tickers with no data: {insufficient_tickers[:5]}...")
 
     metadata_df = pd.DataFrame()
     if metadata_file and os.path.exists(metadata_file):
         try:
-            with open(metadata_file, "r") as f:
-                data = json.load(f)
-            logging.info(f"Metadata file structure: {type(data).__name__}")
-            if isinstance(data, dict):
-                # Old logic: data is a dict with tickers as keys
-                metadata = [
-                    {
-                        "Ticker": t,
-                        "Price": round(float(data[t].get("info", {}).get("Price", np.nan)), 2),
-                        "DVol": data[t].get("info", {}).get("DVol"),
-                        "Sector": data[t].get("info", {}).get("sector"),
-                        "Industry": data[t].get("info", {}).get("industry"),
-                        "AvgVol": data[t].get("info", {}).get("AvgVol"),
-                        "AvgVol10": data[t].get("info", {}).get("AvgVol10"),
-                        "52WKH": data[t].get("info", {}).get("52WKH"),
-                        "52WKL": data[t].get("info", {}).get("52WKL"),
-                        "MCAP": data[t].get("info", {}).get("MCAP"),
-                        "Type": data[t].get("info", {}).get("type")
-                    }
-                    for t in data
-                ]
-            elif isinstance(data, list):
-                # Newer format: list of ticker objects
-                metadata = [
-                    {
-                        "Ticker": item.get("ticker"),
-                        "Price": round(float(item.get("info", {}).get("Price", np.nan)), 2),
-                        "DVol": item.get("info", {}).get("DVol"),
-                        "Sector": item.get("info", {}).get("sector"),
-                        "Industry": item.get("info", {}).get("industry"),
-                        "AvgVol": item.get("info", {}).get("AvgVol"),
-                        "AvgVol10": item.get("info", {}).get("AvgVol10"),
-                        "52WKH": item.get("info", {}).get("52WKH"),
-                        "52WKL": item.get("info", {}).get("52WKL"),
-                        "MCAP": item.get("info", {}).get("MCAP"),
-                        "Type": item.get("info", {}).get("type")
-                    }
-                    for item in data
-                ]
-            else:
-                raise ValueError(f"Unsupported metadata format: {type(data).__name__}")
-            metadata_df = pd.DataFrame(metadata)
+            metadata_df = load_metadata(metadata_file)
             if "Ticker" not in metadata_df.columns or metadata_df.empty:
                 logging.warning(f"Metadata file {metadata_file} invalid or lacks 'Ticker' column. Proceeding without metadata.")
                 metadata_df = pd.DataFrame()
@@ -203,29 +240,18 @@ def main(arctic_db_path, reference_ticker, output_dir, log_file, metadata_file=N
     logging.info(f"Starting RS calculation for {len(tickers)} tickers")
     print(f"🔍 Processing {len(tickers)} tickers...")
 
-    rs_results = []
-    valid_rs_count = 0
-    for ticker in tqdm(tickers, desc="Calculating RS"):
-        if ticker == reference_ticker:
-            continue
-        try:
-            data = lib.read(ticker).data
-            closes = pd.Series(data["close"].values, index=pd.to_datetime(data["datetime"], unit='s'))
-            if len(closes) < 2:
-                rs_results.append((ticker, np.nan, np.nan, np.nan, np.nan))
-                continue
-            rs = relative_strength(closes, ref_closes)
-            rs_1m = relative_strength(closes[:-20], ref_closes[:-20]) if len(closes) > 20 else np.nan
-            rs_3m = relative_strength(closes[:-60], ref_closes[:-60]) if len(closes) > 60 else np.nan
-            rs_6m = relative_strength(closes[:-120], ref_closes[:-120]) if len(closes) > 120 else np.nan
-            rs_results.append((ticker, rs, rs_1m, rs_3m, rs_6m))
-            if not np.isnan(rs):
-                valid_rs_count += 1
-        except Exception as e:
-            logging.info(f"{ticker}: Failed to process ({str(e)})")
-            rs_results.append((ticker, np.nan, np.nan, np.nan, np.nan))
+    ticker_closes = [closes_by_ticker.get(t, np.empty(0, dtype=np.float32)) for t in rs_tickers]
+
+    # All tickers at once: each row holds one ticker's closes, NaN-padded on the right
+    closes_mat, valid_lens = build_closes_matrix(ticker_closes)
+    df_stocks = pd.DataFrame({"Ticker": rs_tickers})
+    strengths = strength_by_offset(closes_mat, valid_lens, offsets)
+    for j, (col, offset) in enumerate(rs_offsets):
+        rs = relative_strength(strengths[:, j], ref_strengths[offset])
+        rs[valid_lens < max(2, offset + 1)] = np.nan
+        df_stocks[col] = rs
+    valid_rs_count = int(df_stocks["RS"].notna().sum())
 
-    df_stocks = pd.DataFrame(rs_results, columns=["Ticker", "RS", "1M_RS", "3M_RS", "6M_RS"])
     if not metadata_df.empty and "Ticker" in metadata_df.columns:
         df_stocks = df_stocks.merge(metadata_df, on="Ticker", how="left")
     else:
@@ -240,19 +266,14 @@ def main(arctic_db_path, reference_ticker, output_dir, log_file, metadata_file=N
 
     # Calculate percentiles (0-99 range) only for non-NaN values
     for col in ["RS", "1M_RS", "3M_RS", "6M_RS"]:
-        valid_values = df_stocks[col].dropna()
-        if not valid_values.empty:
-            df_stocks.loc[valid_values.index, f"{col} Percentile"] = pd.qcut(valid_values.rank(method="min") - 1, 100, labels=False, duplicates="drop")
-        else:
-            df_stocks[f"{col} Percentile"] = np.nan
+        df_stocks[f"{col} Percentile"] = calculate_rs_percentile(df_stocks[col].to_numpy(dtype=float))
 
     df_stocks = df_stocks.sort_values("RS", ascending=False, na_position="last").reset_index(drop=True)
     df_stocks["Rank"] = df_stocks.index + 1
 
     # Add IPO flag only for "Stock" type with less than 20 days
-    df_stocks["IPO"] = df_stocks.apply(
-        lambda row: "Yes" if row["Type"] == "Stock" and len(lib.read(row["Ticker"]).data) < 20 else "No", axis=1
-    )
+    history_lengths = df_stocks["Ticker"].map(dict(zip(rs_tickers, valid_lens))).fillna(0)
+    df_stocks["IPO"] = np.where((df_stocks["Type"] == "Stock") & (history_lengths < 20), "Yes", "No")
 
     df_stocks.loc[df_stocks["Type"] == "ETF", "Industry"] = "ETF"
     df_stocks.loc[df_stocks["Type"] == "ETF", "Sector"] = "ETF"
@@ -262,18 +283,22 @@ def main(arctic_db_path, reference_ticker, output_dir, log_file, metadata_file=N
         os.path.join(output_dir, "rs_stocks.csv"), index=False, na_rep="")
 
     # Aggregate by industry with Tickers sorted by MCAP
+    tickers_by_industry = (
+        df_stocks.sort_values("MCAP", ascending=False, kind="stable", key=lambda mcap: mcap.fillna(0))
+        .groupby("Industry", sort=False)["Ticker"].agg(list).str.join(",")
+    )
     df_industries = df_stocks.groupby("Industry").agg({
         "RS Percentile": "mean",
         "1M_RS Percentile": "mean",
         "3M_RS Percentile": "mean",
         "6M_RS Percentile": "mean",
-        "Sector": "first",
-        "Ticker": lambda x: ",".join(sorted(x, key=lambda t: float(df_stocks.loc[df_stocks["Ticker"] == t, "MCAP"].iloc[0] or 0), reverse=True))
+        "Sector": "first"
     }).reset_index()
+    df_industries["Ticker"] = df_industries["Industry"].map(tickers_by_industry)
 
     # Round percentile means to nearest integer (0–99)
-    for col in ["RS Percentile", "1M_RS Percentile", "3M_RS Percentile", "6M_RS Percentile"]:
-        df_industries[col] = df_industries[col].round().astype(int).fillna(0)
+    percentile_cols = ["RS Percentile", "1M_RS Percentile", "3M_RS Percentile", "6M_RS Percentile"]
+    df_industries[percentile_cols] = df_industries[percentile_cols].fillna(0).round().astype(int)
 
     df_industries = df_industries.sort_values("RS Percentile", ascending=False, na_position="last").reset_index(drop=True)
     df_industries["Rank"] = df_industries.index + 1